@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the ximage import time.
+
+Times "import ximage" and the import of a light function in fresh
+interpreters and checks that the heavy dependencies are not imported.
+Exits with status 1 when a check fails, e.g.::
+
+    python benchmarks/import_time.py --max-ms 200
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+HEAVY = ['scipy', 'skimage', 'matplotlib', 'tifffile', 'dxchange',
+         'pkg_resources']
+
+CASES = [
+    ('import ximage', 'import ximage'),
+    ('ximage.shutter_off', 'import ximage; ximage.shutter_off'),
+]
+
+PROBE = """
+import sys, time, json
+tic = time.time()
+{statement}
+elapsed = time.time() - tic
+heavy = sorted(set(m.split('.')[0] for m in sys.modules) & set({heavy!r}))
+print(json.dumps([elapsed, heavy]))
+"""
+
+def measure(statement, repeat):
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = top + os.pathsep + env.get('PYTHONPATH', '')
+    code = PROBE.format(statement=statement, heavy=HEAVY)
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        elapsed, heavy = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(elapsed)
+    return sorted(times)[len(times) // 2], heavy
+
+def main(arg):
+    parser = argparse.ArgumentParser(description='Benchmark the ximage import time.')
+    parser.add_argument('--repeat', type=int, default=5, help='Interpreters started per case (default 5)')
+    parser.add_argument('--max-ms', type=float, default=None, help='Fail above this median import time in ms')
+    args = parser.parse_args(arg)
+
+    failed = False
+    for name, statement in CASES:
+        elapsed, heavy = measure(statement, args.repeat)
+        print("%-20s %8.1f ms  heavy modules: %s" % (name, 1000 * elapsed, ', '.join(heavy) or 'none'))
+        if heavy:
+            failed = True
+        if args.max_ms is not None and 1000 * elapsed > args.max_ms:
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
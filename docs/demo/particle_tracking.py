@@ -10,18 +10,9 @@ from __future__ import print_function
 import os
 import sys
 import argparse
-import fnmatch
 import numpy as np
 import tomopy
 
-import pandas as pd
-from pandas import DataFrame, Series  # for convenience
-
-import pims
-import trackpy as tp
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-
 import ximage
 
 def main(arg):
@@ -29,32 +20,36 @@ def main(arg):
     parser = argparse.ArgumentParser()
     parser.add_argument("top", help="top directory where the tiff images are located: /data/")
     parser.add_argument("start", nargs='?', const=1, type=int, default=1, help="index of the first image: 10001 (default 1)")
+    parser.add_argument("--prefix", default=None, help="file name prefix of the image series when top holds several: proj_")
 
     args = parser.parse_args()
 
     top = args.top
     index_start = int(args.start)
+    prefix = args.prefix
 
-    # Total number of images to read
-    nfile = len(fnmatch.filter(os.listdir(top), '*.tif'))
+    # Index the tiff images once, load_raw reuses the cached index
+    nfile = len(ximage.index_directory(top).select(index_start, prefix=prefix))
 
-    # Read the raw data
-    rdata = ximage.load_raw(top, index_start)
+    # Open the raw data, frames are decoded only when used
+    rdata = ximage.load_raw(top, index_start, lazy=True, prefix=prefix)
 
-    particle_bed_reference = ximage.particle_bed_location(rdata[0])
+    # Find the particle bed, the shutter closing and the laser on images
+    # in a single pass over the images
+    events = ximage.detect_events(rdata, laser_alpha=1.00)
+    particle_bed_reference = events.particle_bed[0]
     print("Particle bed location: ", particle_bed_reference)
-    
-    # Cut the images to remove the particle bed
-    cdata = rdata[:, 0:particle_bed_reference, :]
 
-    # Find the image when the shutter starts to close
-    dark_index = ximage.shutter_off(rdata)
+    dark_index = events.shutter_off
     print("Shutter CLOSED on image: ", dark_index)
 
-    # Find the images when the laser is on
-    laser_on_index = ximage.laser_on(rdata, particle_bed_reference, alpha=1.00)
+    laser_on_index = events.laser_on
     print("Laser ON on image: ", laser_on_index)
 
+    # Read the images above the particle bed only
+    cdata = ximage.load_raw(top, index_start, rows=(0, particle_bed_reference),
+                            prefix=prefix)
+
     # Set the [start, end] index of the blocked images, flat and dark.
     laser_on_index = 47
     flat_range = [0, 1]
@@ -77,19 +72,14 @@ def main(arg):
     ndata = ximage.sobel_stack(ndata)
     ximage.slider(ndata[150:160:,:])
 
-#    ndata = tomopy.normalize(proj, flat, dark)
-#    ndata = tomopy.normalize_bg(ndata, air=ndata.shape[2]/2.5)
-#    ndata = tomopy.minus_log(ndata)
-
-#    blur_radius = 3.0
-#    threshold = .04
-#    nddata = ximage.label(ndata, blur_radius, threshold)
-
-#    f = tp.locate(ndata[100, :, :], 41, invert=True)
-#    print(f.head)
-#    plt.figure()  # make a new figure
-#    tp.annotate(f, ndata[100, :, :]);
-#    ximage.slider(nddata)
+    # Label the particles and link them into trajectories
+    blur_radius = 3.0
+    threshold = .04
+    labels, nr_objects, regions = ximage.label(ndata, blur_radius, threshold)
+    particle = ximage.link(regions, max_displacement=20, memory=2)
+    tracks = ximage.trajectories(regions, particle)
+    print("Tracked particles: ", len(tracks['offsets']) - 1)
+    ximage.slider(labels[150:160:,:])
 
 
 if __name__ == "__main__":
@@ -11,13 +11,17 @@ setup(
     description = 'Data analysis for x-ray images at the APS.',
     license='BSD-3',
     platforms='Any',
+    python_requires='>=3.7',
+    entry_points={
+        'console_scripts': ['ximage-align = ximage.align:main'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Science/Research',
         'License :: BSD-3',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
     ],
 )
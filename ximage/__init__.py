@@ -48,12 +48,74 @@
 
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-from ximage.util import *
-from ximage.align import *
-from ximage.widget import *
-
-try:
-    import pkg_resources
-    __version__ = pkg_resources.working_set.require("ximage")[0].version
-except:
-    pass
+import importlib
+
+# The submodules, and their dependencies, are imported on first use of
+# one of their names so that "import ximage" stays cheap.
+_submodules = {
+    'util': ['load_raw',
+             'DirectoryIndex',
+             'index_directory',
+             'TiffStack',
+             'shutter_off',
+             'particle_bed_location',
+             'particle_bed_trajectory',
+             'laser_on',
+             'detect_events',
+             'scale_to_one',
+             'sobel_stack',
+             'label',
+             'label_3d',
+             'scale_to_one_frames',
+             'sobel_frames',
+             'label_frames',
+             'pipeline'],
+    'align': ['Registration',
+              'alignment_pass',
+              'transform_image',
+              'transform_stack',
+              'drift_correction',
+              'affine_warp',
+              'image_corrections',
+              'align_images',
+              'logpolar_fancy',
+              'logpolar_interp',
+              'batch_corrections',
+              'write_corrections',
+              'save_transform_cache',
+              'load_transform_cache'],
+    'widget': ['slider'],
+    'linking': ['link',
+                'trajectories'],
+}
+
+_names = dict((name, module) for module, names in _submodules.items()
+              for name in names)
+
+__all__ = sorted(_names)
+
+
+def __getattr__(name):
+    if name in _names:
+        module = importlib.import_module('ximage.' + _names[name])
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    if name in _submodules:
+        return importlib.import_module('ximage.' + name)
+    if name == '__version__':
+        globals()[name] = _version()
+        return globals()[name]
+    raise AttributeError("module 'ximage' has no attribute %r" % name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_submodules) + __all__ + ['__version__'])
+
+
+def _version():
+    try:
+        from importlib.metadata import version
+        return version("ximage")
+    except Exception:
+        return None
@@ -3,29 +3,51 @@ from __future__ import print_function
 
 import sys
 import os
+import csv
+import json
+import time
+import shutil
 import argparse
+import tempfile
+import threading
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from scipy.optimize import least_squares
-from skimage.filters import threshold_li
-from skimage.io import imread
-from skimage.feature import register_translation
-from skimage.transform import AffineTransform, warp, FundamentalMatrixTransform
 import numpy as np
 
+from ximage import _lazy
+
+ndi = _lazy.module('scipy.ndimage')
+skio = _lazy.module('skimage.io')
+
 #import dxchange
-import matplotlib.pyplot as plt
+
+logger = logging.getLogger(__name__)
 
 
 __authors__ = "Mark Wolfman"
 __copyright__ = "Copyright (c) 2017, Argonne National Laboratory"
 __version__ = "0.0.1"
-__all__ = ['alignment_pass',
+__all__ = ['Registration',
+           'alignment_pass',
            'transform_image',
-           'image_corrections']
+           'transform_stack',
+           'drift_correction',
+           'affine_warp',
+           'image_corrections',
+           'align_images',
+           'logpolar_fancy',
+           'logpolar_interp',
+           'batch_corrections',
+           'write_corrections',
+           'save_transform_cache',
+           'load_transform_cache']
 
 def flip(m, axis):
     if not hasattr(m, 'ndim'):
-        m = asarray(m)
+        m = np.asarray(m)
     indexer = [slice(None)] * m.ndim
     try:
         indexer[axis] = slice(None, None, -1)
@@ -35,24 +57,149 @@ def flip(m, axis):
     return m[tuple(indexer)]
 
 
-def alignment_pass(img, img_180):
-    upsample = 200
-    # Register the translation correction
-    # print(img.shape)
-    # print(img_180.shape)
-    trans = register_translation(img, img_180, upsample_factor=upsample)
-    trans = trans[0]
-    # Register the rotation correction
-    lp_center = (img.shape[0] / 2, img.shape[1] / 2)
-    # lp_center = (0, 0)
-    img_ft = np.fft.fft2(img)
-    img_180_ft = np.fft.fft2(img_180)
-    img_lp = logpolar_fancy(img, *lp_center)
-    img_180_lp = logpolar_fancy(img_180, *lp_center)
-    result = register_translation(img_lp, img_180_lp, upsample_factor=upsample)
-    scale_rot = result[0]
-    angle = np.degrees(scale_rot[1] / img_lp.shape[1] * 2 * np.pi)
-    return angle, trans
+def _upsampled_dft(data, region_size, upsample_factor, offsets):
+    # Matrix multiply DFT of data upsampled in a region_size window
+    im2pi = 1j * 2 * np.pi
+    (nr, nc) = data.shape
+    col_kernel = np.exp(
+        -im2pi / (nc * upsample_factor) *
+        np.outer(np.fft.ifftshift(np.arange(nc)) - np.floor(nc / 2),
+                 np.arange(region_size) - offsets[1]))
+    row_kernel = np.exp(
+        -im2pi / (nr * upsample_factor) *
+        np.outer(np.arange(region_size) - offsets[0],
+                 np.fft.ifftshift(np.arange(nr)) - np.floor(nr / 2)))
+    return row_kernel.dot(data).dot(col_kernel)
+
+
+def _phase_correlation(src_ft, target_ft, upsample_factor=1, max_shift=None):
+    """Translation registering target with src, from their Fourier
+    transforms, as in skimage register_translation.
+
+    If max_shift is given the correlation peak is only searched within
+    max_shift pixels.
+    """
+    shape = src_ft.shape
+    image_product = src_ft * target_ft.conj()
+    cross_correlation = np.abs(np.fft.ifft2(image_product))
+    if max_shift is not None:
+        rows = np.abs(np.fft.fftfreq(shape[0]) * shape[0]) <= max_shift
+        cols = np.abs(np.fft.fftfreq(shape[1]) * shape[1]) <= max_shift
+        cross_correlation *= np.outer(rows, cols)
+    maxima = np.unravel_index(np.argmax(cross_correlation), shape)
+    midpoints = np.array([np.fix(axis_size / 2) for axis_size in shape])
+    shifts = np.array(maxima, dtype=np.float64)
+    shifts[shifts > midpoints] -= np.array(shape)[shifts > midpoints]
+    if upsample_factor > 1:
+        shifts = _refine_shift(image_product, shifts, upsample_factor)
+    return shifts
+
+
+def _refine_shift(image_product, shifts, upsample_factor):
+    # Refine the peak in a 1.5 pixel window upsampled by upsample_factor.
+    # Large factors first locate the peak to about 1 / sqrt(upsample_factor)
+    # pixel and then only upsample a few of those steps around it, which
+    # needs far fewer DFT rows than the whole window at full precision.
+    data = image_product.conj()
+    window = 1.5
+    if upsample_factor > 10:
+        coarse_factor = int(np.ceil(np.sqrt(upsample_factor)))
+        shifts = _upsampled_peak(data, shifts, coarse_factor, window)
+        window = 3.0 / coarse_factor
+    return _upsampled_peak(data, shifts, upsample_factor, window)
+
+
+def _upsampled_peak(data, shifts, upsample_factor, window):
+    # Peak of the upsampled cross correlation in a window around shifts
+    shifts = np.round(shifts * upsample_factor) / upsample_factor
+    region_size = np.ceil(upsample_factor * window)
+    dftshift = np.fix(region_size / 2.0)
+    offsets = dftshift - shifts * upsample_factor
+    cross_correlation = _upsampled_dft(data, int(region_size),
+                                       upsample_factor, offsets)
+    maxima = np.unravel_index(np.argmax(np.abs(cross_correlation)),
+                              cross_correlation.shape)
+    return shifts + (np.array(maxima, dtype=np.float64) - dftshift) / upsample_factor
+
+
+class Registration(object):
+    """Register images against a fixed reference image.
+
+    The Fourier transforms of the reference image and of its log-polar
+    transform are computed once, so registering an image only transforms
+    the moving image.
+
+    Parameters
+    ----------
+    reference : ndarray
+      2D reference image.
+    upsample_factor : int, optional
+      Registration precision is 1 / upsample_factor pixels.
+    order : int, optional
+      Log-polar interpolation order, None for `logpolar_fancy`.
+    window : bool, optional
+      Apply a Hann window to the images before the transforms to reduce
+      the edge effects.
+    max_shift : float, optional
+      Only search translations up to max_shift pixels, e.g. when refining
+      a coarse estimate.
+    """
+
+    def __init__(self, reference, upsample_factor=200, order=1, window=False,
+                 max_shift=None):
+        self.shape = reference.shape
+        self.upsample_factor = upsample_factor
+        self.order = order
+        self.max_shift = max_shift
+        self.lp_center = (self.shape[0] / 2, self.shape[1] / 2)
+        if window:
+            self.window = np.outer(np.hanning(self.shape[0]),
+                                   np.hanning(self.shape[1]))
+        else:
+            self.window = None
+        reference = self._prepare(reference)
+        self.reference_ft = np.fft.fft2(reference)
+        self.reference_lp_ft = np.fft.fft2(self._logpolar(reference))
+
+    def _prepare(self, img):
+        if self.window is None:
+            return img
+        return img * self.window
+
+    def _logpolar(self, img):
+        if self.order is None:
+            return logpolar_fancy(img, *self.lp_center)
+        return logpolar_interp(img, *self.lp_center, order=self.order)
+
+    def register(self, img):
+        """Register an image against the reference image.
+
+        Parameters
+        ----------
+        img : ndarray
+          2D moving image, same shape as the reference image.
+
+        Returns
+        -------
+        angle : float
+          Rotation correction in degrees.
+        trans : ndarray
+          Translation correction in (vert, horiz) order.
+        """
+        img = self._prepare(img)
+        # Register the translation correction
+        trans = _phase_correlation(np.fft.fft2(img), self.reference_ft,
+                                   self.upsample_factor, self.max_shift)
+        # Register the rotation correction
+        img_lp = self._logpolar(img)
+        scale_rot = _phase_correlation(np.fft.fft2(img_lp), self.reference_lp_ft,
+                                       self.upsample_factor)
+        angle = np.degrees(scale_rot[1] / img_lp.shape[1] * 2 * np.pi)
+        return angle, trans
+
+
+def alignment_pass(img, img_180, order=1):
+    return Registration(img_180, order=order).register(img)
 
 
 def _transformation_matrix(r=0, tx=0, ty=0, sx=1, sy=1):
@@ -65,7 +212,66 @@ def _transformation_matrix(r=0, tx=0, ty=0, sx=1, sy=1):
     return new_transform
 
 
-def transform_image(img, rotation=0, translation=(0, 0)):
+def _image_matrix(shape, rotation=0, translation=(0, 0)):
+    # Rotation about the image center followed by the translation
+    rot_center = (shape[1] / 2, shape[0] / 2)
+    xy_trans = (translation[1], translation[0])
+    M0 = _transformation_matrix(tx=-rot_center[0], ty=-rot_center[1])
+    M1 = _transformation_matrix(r=np.radians(rotation), tx=xy_trans[0], ty=xy_trans[1])
+    M2 = _transformation_matrix(tx=rot_center[0], ty=rot_center[1])
+    # python 3.6
+    # M = M2 @ M1 @ M0
+    MT = np.dot(M1, M0)
+    M = np.dot(M2, MT)
+    return M
+
+
+def _image_params(shape, M):
+    # Inverse of _image_matrix: rotation and (vert, horiz) translation
+    rot_center = (shape[1] / 2, shape[0] / 2)
+    M0 = _transformation_matrix(tx=rot_center[0], ty=rot_center[1])
+    M2 = _transformation_matrix(tx=-rot_center[0], ty=-rot_center[1])
+    M1 = np.dot(M2, np.dot(M, M0))
+    rotation = np.degrees(np.arctan2(M1[1, 0], M1[0, 0]))
+    return rotation, np.array([M1[1, 2], M1[0, 2]])
+
+
+def affine_warp(img, M, order=1, out=None, dtype=None):
+    """Warp an image with an affine matrix.
+
+    Parameters
+    ----------
+    img : ndarray
+      2D image.
+    M : ndarray
+      3x3 matrix mapping the output (x, y) coordinates to the input ones,
+      as built by `transform_image`.
+    order : int, optional
+      Spline interpolation order.
+    out : ndarray, optional
+      Output image.
+    dtype : data-type, optional
+      Data type of the allocated output image, default is the image type
+      for floating point images and float32 otherwise.
+
+    Returns
+    -------
+    ndarray
+      Warped image, pixels mapped from outside the image are 0.
+    """
+    if out is None:
+        if dtype is None:
+            dtype = img.dtype if img.dtype.kind == 'f' else np.float32
+        out = np.empty(img.shape, dtype=dtype)
+    # ndimage works in (row, col) coordinates
+    matrix = M[1::-1, 1::-1]
+    offset = M[1::-1, 2]
+    ndi.affine_transform(img, matrix, offset=offset, output=out, order=order,
+                         mode='constant', cval=0)
+    return out
+
+
+def transform_image(img, rotation=0, translation=(0, 0), order=1, out=None):
     """Take a set of transformations and apply them to the image.
     
     Rotations occur around the center of the image, rather than the
@@ -77,93 +283,595 @@ def transform_image(img, rotation=0, translation=(0, 0)):
       Translation parameters in (vert, horiz) order.
     rotation : float, optional
       Rotation in degrees.
-    scale : 2-tuple, optional
-      Scaling parameters in (vert, horiz) order.
+    order : int, optional
+      Spline interpolation order.
+    out : ndarray, optional
+      Output image, by default float32 for integer images.
     
     """
-    rot_center = (img.shape[1] / 2, img.shape[0] / 2)
-    xy_trans = (translation[1], translation[0])
-    M0 = _transformation_matrix(tx=-rot_center[0], ty=-rot_center[1])
-    M1 = _transformation_matrix(r=np.radians(rotation), tx=xy_trans[0], ty=xy_trans[1])
-    M2 = _transformation_matrix(tx=rot_center[0], ty=rot_center[1])
-    # python 3.6
-    # M = M2 @ M1 @ M0
-    MT = np.dot(M1, M0)
-    M = np.dot(M2, MT)
+    M = _image_matrix(img.shape, rotation, translation)
+    out = affine_warp(img, M, order=order, out=out)
+    return out
 
-    tr = FundamentalMatrixTransform(M)
-    out = warp(img, tr)
+
+def transform_stack(stack, rotation=0, translation=(0, 0), order=1, out=None,
+                    workers=1):
+    """Apply a rotation and translation to each image of a stack.
+
+    Parameters
+    ----------
+    stack : ndarray
+      3D stack of images.
+    rotation : float or ndarray, optional
+      Rotation in degrees, one for all the images or one per image.
+    translation : ndarray, optional
+      Translation in (vert, horiz) order, shape (2,) or (nimages, 2).
+    order : int, optional
+      Spline interpolation order.
+    out : ndarray, optional
+      Output stack, by default float32 for integer stacks.
+    workers : int, optional
+      Number of threads warping the images.
+
+    Returns
+    -------
+    ndarray
+      3D stack of transformed images.
+    """
+    nimages = stack.shape[0]
+    rotation = np.broadcast_to(rotation, (nimages,))
+    translation = np.broadcast_to(translation, (nimages, 2))
+    if out is None:
+        dtype = stack.dtype if stack.dtype.kind == 'f' else np.float32
+        out = np.empty(stack.shape, dtype=dtype)
+
+    def warp_image(index):
+        transform_image(stack[index], rotation[index], translation[index],
+                        order=order, out=out[index])
+
+    if workers > 1 and nimages > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(warp_image, range(nimages)))
+    else:
+        for index in range(nimages):
+            warp_image(index)
     return out
 
 
-def image_corrections(img_name_0, img_name_180, passes=15):
-    img = imread(img_name_0)
-#    img = dxchange.read_tiff(img_name_0)
-    plt.imshow(img, interpolation='nearest', cmap='gray')
-    plt.show()
-    img_180 = imread(img_name_180)
-#    img_180 = dxchange.read_tiff(img_name_180)
-    plt.imshow(img_180, interpolation='nearest', cmap='gray')
-    plt.show()
+def _downsample(img, factor):
+    # Block mean over factor x factor pixels
+    if factor == 1:
+        return img
+    rows, cols = img.shape[0] // factor, img.shape[1] // factor
+    blocks = img[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def _align(img, img_180, passes=15, order=1, tol=0.01, levels=1,
+           upsample_factor=200, callback=None, refine_passes=2):
+    """Find the composed matrix registering img with img_180.
+
+    With levels > 1 the matrix is first estimated on images downsampled by
+    2 ** (levels - 1), then refined on each finer level with the search
+    bounded to the error of the coarser level. Every level registers with
+    the same upsample_factor, so a coarse level only stops once its
+    estimate is within tol of its own pixels, and the full resolution
+    level runs at most refine_passes passes.
+    """
+    history = []
+    M = np.identity(3)
+    for level in reversed(range(levels)):
+        factor = 2 ** level
+        level_img = _downsample(img, factor)
+        level_180 = _downsample(img_180, factor)
+        if level == levels - 1:
+            max_shift = None
+        else:
+            # Bring the coarser estimate to this level
+            coarse_shape = (img.shape[0] // (2 * factor), img.shape[1] // (2 * factor))
+            angle, trans = _image_params(coarse_shape, M)
+            M = _image_matrix(level_img.shape, angle, 2 * trans)
+            max_shift = 3
+        registration = Registration(
+            level_180, order=order, max_shift=max_shift,
+            upsample_factor=upsample_factor)
+        level_passes = passes
+        if level == 0 and levels > 1:
+            level_passes = min(passes, refine_passes)
+        if tol is not None:
+            # A pass cannot resolve less than 1 / upsample_factor pixel
+            level_tol = max(tol, 1 / upsample_factor) * factor
+        for pass_ in range(level_passes):
+            # Prepare the inter-translated images
+            working_img = affine_warp(level_img, M)
+            # Calculate a new transformation
+            angle, trans = registration.register(working_img)
+            history.append((angle, trans[0] * factor, trans[1] * factor))
+            logger.debug("Level %d pass %d: %.4f deg, %.4f px, %.4f px",
+                         level, pass_, *history[-1])
+            if callback is not None:
+                callback(level, pass_, working_img, level_180, angle, trans)
+            # Compose with the cumulative transformation
+            M = np.dot(M, _image_matrix(level_img.shape, angle, trans))
+            if tol is not None and np.all(np.abs(history[-1]) < level_tol):
+                break
+    return M, np.array(history)
+
+
+def align_images(img, img_180, passes=15, order=1, tol=0.01, levels=1,
+                 callback=None):
+    """Find the rotation and translation between a 0° and a 180° image.
+
+    Each pass registers the corrected 0° image against the 180° image and
+    composes the correction with the previous ones. The composed transform
+    is applied to the original image once per pass, so interpolation
+    errors do not pile up. Nothing is displayed, use callback to plot the
+    passes.
+
+    Parameters
+    ----------
+    img, img_180 : ndarray
+      0° and 180° images, the 0° image is flipped here.
+    passes : int, optional
+      Largest number of passes per pyramid level. After a coarser level
+      the full resolution level runs at most two passes.
+    order : int, optional
+      Log-polar interpolation order, None for `logpolar_fancy`.
+    tol : float, optional
+      Stop once a pass corrects less than tol degrees and tol pixels.
+      None always runs all the passes.
+    levels : int, optional
+      Number of pyramid levels. With levels > 1 the offsets are first
+      estimated on images downsampled by 2 ** (levels - 1) and only
+      refined at full resolution, which is faster but can stop short of
+      the full resolution estimate when the passes converge slowly.
+    callback : callable, optional
+      Called after each pass as callback(level, pass_, working_img,
+      img_180, angle, trans) with the images of the pyramid level.
+
+    Returns
+    -------
+    cume_angle : float
+      Rotation in degrees.
+    cume_trans : tuple
+      Translation in (x, y) order.
+    diagnostics : dict
+      'history': (angle, vert, horiz) correction of each pass, 'passes':
+      number of passes and 'matrix': composed 3x3 transform.
+    """
     # python 3.6
     # img = np.flip(img, 1)
     img = flip(img, 1)
-    cume_angle = 0
-    cume_trans = np.array([0, 0], dtype=float)
-    for pass_ in range(passes):
-        # Prepare the inter-translated images
-        working_img = transform_image(img, translation=cume_trans, rotation=cume_angle)
-        # Calculate a new transformation
-        print(pass_)
-        angle, trans = alignment_pass(working_img, img_180)
-        # Save the cumulative transformations
-        cume_angle += angle
-        cume_trans += np.array(trans)
+    M, history = _align(img, img_180, passes=passes, order=order, tol=tol,
+                        levels=levels, callback=callback)
+    cume_angle, cume_trans = _image_params(img.shape, M)
     # Convert translations to (x, y)
     cume_trans = (-cume_trans[1], cume_trans[0])
+    diagnostics = {'history': history, 'passes': len(history), 'matrix': M}
+    return cume_angle, cume_trans, diagnostics
+
+
+def _show(img):
+    import matplotlib.pyplot as plt
+    plt.imshow(img, interpolation='nearest', cmap='gray')
+    plt.show()
+
+
+def image_corrections(img_name_0, img_name_180, passes=15, order=1, tol=0.01,
+                      levels=1, return_history=False, show=False,
+                      callback=None):
+    """Find the rotation and translation between a 0° and a 180° image file.
+
+    Reads the images and calls `align_images`.
+
+    Parameters
+    ----------
+    img_name_0, img_name_180 : str
+      File names of the 0° and 180° images.
+    passes, order, tol, levels, callback : optional
+      Parameters of `align_images`.
+    return_history : bool, optional
+      Also return the (angle, vert, horiz) correction of each pass.
+    show : bool, optional
+      Display the images with matplotlib before the alignment, this
+      blocks until the windows are closed.
+
+    Returns
+    -------
+    cume_angle : float
+      Rotation in degrees.
+    cume_trans : tuple
+      Translation in (x, y) order.
+    history : ndarray
+      Only if return_history is True, correction of each pass.
+    """
+    img = skio.imread(img_name_0)
+#    img = dxchange.read_tiff(img_name_0)
+    img_180 = skio.imread(img_name_180)
+#    img_180 = dxchange.read_tiff(img_name_180)
+    if show:
+        _show(img)
+        _show(img_180)
+    cume_angle, cume_trans, diagnostics = align_images(
+        img, img_180, passes=passes, order=order, tol=tol, levels=levels,
+        callback=callback)
+    if return_history:
+        return cume_angle, cume_trans, diagnostics['history']
     return cume_angle, cume_trans
 
 
-_transforms = {}
+def _correct_pair(job):
+    # Worker of batch_corrections, never plots
+    img_name_0, img_name_180, kwargs = job
+    result = {'image_0': img_name_0, 'image_180': img_name_180,
+              'rotation': None, 'x': None, 'y': None, 'passes': 0,
+              'seconds': 0.0, 'error': ''}
+    tic = time.time()
+    try:
+        rotation, trans, diagnostics = align_images(
+            skio.imread(img_name_0), skio.imread(img_name_180), **kwargs)
+        result.update(rotation=float(rotation), x=float(trans[0]),
+                      y=float(trans[1]), passes=diagnostics['passes'])
+    except Exception as err:
+        result['error'] = '%s: %s' % (type(err).__name__, err)
+    result['seconds'] = time.time() - tic
+    return result
+
+
+def _init_worker(cache_fname):
+    if cache_fname is not None:
+        load_transform_cache(cache_fname)
+
+
+def batch_corrections(pairs, processes=None, passes=15, order=1, tol=0.01,
+                      levels=1):
+    """Find the rotation and translation of many 0°/180° image pairs.
+
+    The pairs are spread over a pool of processes. The log-polar tables of
+    the first pair geometry are built once and loaded by every process.
+
+    Parameters
+    ----------
+    pairs : list of 2-tuple
+      (0° image, 180° image) file names.
+    processes : int, optional
+      Number of processes, default is the number of cores.
+    passes, order, tol, levels : optional
+      Parameters of `image_corrections`.
+
+    Returns
+    -------
+    list of dict
+      One result per pair, in order, with keys 'image_0', 'image_180',
+      'rotation' (degrees), 'x', 'y' (pixels, None if the pair failed),
+      'passes', 'seconds' and 'error' (empty unless the pair failed).
+    """
+    pairs = list(pairs)
+    kwargs = dict(passes=passes, order=order, tol=tol, levels=levels)
+    jobs = [(img_0, img_180, kwargs) for img_0, img_180 in pairs]
+    if not jobs:
+        return []
+    cache_dir = tempfile.mkdtemp()
+    cache_fname = os.path.join(cache_dir, 'transforms.npz')
+    try:
+        # Build the tables of every pyramid level in this process
+        shape = skio.imread(pairs[0][1]).shape
+        for level in range(levels):
+            level_shape = _downsample(np.zeros(shape, dtype=np.float32), 2 ** level).shape
+            center = (level_shape[0] / 2, level_shape[1] / 2)
+            if order is None:
+                logpolar_fancy(np.zeros(level_shape, dtype=np.float32), *center)
+            else:
+                logpolar_interp(np.zeros(level_shape, dtype=np.float32), *center)
+        save_transform_cache(cache_fname)
+    except Exception:
+        cache_fname = None
+    try:
+        pool = multiprocessing.Pool(processes, _init_worker, (cache_fname,))
+        try:
+            results = pool.map(_correct_pair, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+def write_corrections(results, fname):
+    """Write the results of `batch_corrections` to a .json or .csv file.
+
+    Parameters
+    ----------
+    results : list of dict
+      Results of `batch_corrections`.
+    fname : str
+      Output file name, the format follows the extension.
+    """
+    fields = ['image_0', 'image_180', 'rotation', 'x', 'y', 'passes',
+              'seconds', 'error']
+    if fname.lower().endswith('.json'):
+        with open(fname, 'w') as fout:
+            json.dump(results, fout, indent=2, allow_nan=False)
+    else:
+        with open(fname, 'w', newline='') as fout:
+            writer = csv.DictWriter(fout, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def main(argv=None):
+    """Command line entry point of the batch 0°/180° alignment."""
+    parser = argparse.ArgumentParser(
+        description='Find the rotation/translation offsets of many pairs of '
+                    '0 and 180 deg images.')
+    parser.add_argument('images', nargs='*',
+                        help='0 deg and 180 deg image files, pair by pair.')
+    parser.add_argument('--pairs', help='Text file with one "0 deg image, '
+                        '180 deg image" pair per line.')
+    parser.add_argument('--output', '-o', default='corrections.csv',
+                        help='Output .csv or .json file.')
+    parser.add_argument('--processes', '-j', type=int, default=None,
+                        help='Number of processes (default: all cores).')
+    parser.add_argument('--passes', '-p', help='How many iterations to run.',
+                        default=15, type=int)
+    parser.add_argument('--tol', type=float, default=0.01,
+                        help='Stop when a pass corrects less than this.')
+    parser.add_argument('--levels', type=int, default=1,
+                        help='Number of pyramid levels.')
+    args = parser.parse_args(argv)
+    if len(args.images) % 2:
+        parser.error('images must be given in 0 deg, 180 deg pairs')
+    pairs = list(zip(args.images[0::2], args.images[1::2]))
+    if args.pairs:
+        with open(args.pairs) as fin:
+            for line in fin:
+                fields = line.replace(',', ' ').split()
+                if len(fields) == 2:
+                    pairs.append(tuple(fields))
+    tic = time.time()
+    results = batch_corrections(pairs, processes=args.processes,
+                                passes=args.passes, tol=args.tol,
+                                levels=args.levels)
+    elapsed = time.time() - tic
+    write_corrections(results, args.output)
+    failed = sum(1 for result in results if result['error'])
+    print("Aligned %d pairs (%d failed) in %.1f s, results in %s" % (
+        len(results), failed, elapsed, args.output))
+    return 1 if failed else 0
+
+
+def drift_correction(stack, reference=0, running=None, upsample_factor=20,
+                     chunk=32, workers=1, correct=False, out=None, order=1):
+    """Find the frame to frame drift of a stack of images.
+
+    Each image is registered against a reference image by phase
+    correlation. The Fourier transforms of chunk images are computed at
+    once and the reference spectrum is computed once per reference. With a
+    fixed reference the chunks are registered, and corrected, on a pool of
+    workers threads. With a running reference the chunks are registered
+    one after the other and only the correction of each chunk is threaded.
+
+    Parameters
+    ----------
+    stack : ndarray
+      3D stack of images, e.g. a ximage.TiffStack.
+    reference : int or ndarray, optional
+      Index of the reference image or 2D reference image.
+    running : float, optional
+      If given the reference is a running average of the corrected
+      images: after each chunk it is updated as
+      (1 - running) * reference + running * chunk mean.
+    upsample_factor : int, optional
+      Registration precision is 1 / upsample_factor pixels.
+    chunk : int, optional
+      Number of images transformed at once.
+    workers : int, optional
+      Number of threads.
+    correct : bool, optional
+      Also return the drift corrected stack.
+    out : ndarray, optional
+      Corrected stack, by default a new float32 stack.
+    order : int, optional
+      Spline interpolation order of the correction.
+
+    Returns
+    -------
+    shifts : ndarray
+      (nimages, 2) translation in (vert, horiz) order registering each
+      image with the reference, as used by `transform_image`.
+    corrected : ndarray
+      Only if correct is True, the drift corrected stack.
+    """
+    nimages = stack.shape[0]
+    if np.ndim(reference) == 0:
+        reference = stack[int(reference)]
+    reference = np.asarray(reference, dtype=np.float32)
+    reference_ft = np.fft.fft2(reference)
+    shifts = np.empty((nimages, 2))
+    if correct and out is None:
+        out = np.empty(stack.shape, dtype=np.float32)
+    if workers > 1 and running is None:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    else:
+        pool = None
+
+    def register_chunk(start, reference_ft, warp_workers=1):
+        # Registers a chunk and, while it is in memory, warps it into out
+        # when correcting or returns it warped for the running average.
+        block = np.asarray(stack[start:start + chunk], dtype=np.float32)
+        image_product = np.fft.fft2(block, axes=(1, 2)) * reference_ft.conj()
+        cross_correlation = np.abs(np.fft.ifft2(image_product, axes=(1, 2)))
+        # Integer peak of every image at once
+        peaks = cross_correlation.reshape(len(block), -1).argmax(axis=1)
+        block_shifts = np.stack(np.unravel_index(peaks, block.shape[1:]), axis=1).astype(np.float64)
+        size = np.array(block.shape[1:])
+        wrap = block_shifts > np.fix(size / 2)
+        block_shifts[wrap] -= np.broadcast_to(size, block_shifts.shape)[wrap]
+        if upsample_factor > 1:
+            for n in range(len(block)):
+                block_shifts[n] = _refine_shift(image_product[n], block_shifts[n],
+                                                upsample_factor)
+        shifts[start:start + len(block)] = block_shifts
+        if not correct and running is None:
+            return None
+        return transform_stack(block, 0, block_shifts, order=order,
+                               out=out[start:start + len(block)] if correct else None,
+                               workers=warp_workers)
+
+    try:
+        starts = range(0, nimages, chunk)
+        if running is None:
+            if pool is None:
+                for start in starts:
+                    register_chunk(start, reference_ft, workers)
+            else:
+                list(pool.map(lambda start: register_chunk(start, reference_ft), starts))
+        else:
+            for start in starts:
+                corrected = register_chunk(start, reference_ft, workers)
+                reference = (1 - running) * reference + running * corrected.mean(axis=0)
+                reference_ft = np.fft.fft2(reference)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if correct:
+        return shifts, out
+    return shifts
+
+
+def _nbytes(arrays):
+    if isinstance(arrays, np.ndarray):
+        return arrays.nbytes
+    return sum(_nbytes(a) for a in arrays)
+
+
+class _TransformCache(object):
+    """
+    Thread-safe least recently used cache of the log-polar lookup tables,
+    holding at most max_bytes of arrays.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            transform = self._entries.pop(key, None)
+            if transform is not None:
+                self._entries[key] = transform
+            return transform
+
+    def put(self, key, transform):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= _nbytes(old)
+            self._entries[key] = transform
+            self.nbytes += _nbytes(transform)
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= _nbytes(old)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+
+_transforms = _TransformCache()
+
+
+def save_transform_cache(fname):
+    """Save the cached log-polar lookup tables and grids to a .npz file.
+
+    Loading the file with `load_transform_cache` lets later runs at the
+    same image geometry skip building the tables.
+
+    Parameters
+    ----------
+    fname : str
+      Output file name.
+    """
+    arrays = {}
+    items = _transforms.items()
+    arrays['keys'] = np.array([key for key, transform in items], dtype=float).reshape(-1, 6)
+    for n, (key, ((p_k, t_k), (i_k, j_k))) in enumerate(items):
+        arrays['table_%d' % n] = np.stack([p_k, t_k, i_k, j_k])
+    items = _grids.items()
+    arrays['grid_keys'] = np.array([key for key, grid in items], dtype=float).reshape(-1, 6)
+    for n, (key, (grid,)) in enumerate(items):
+        arrays['grid_%d' % n] = grid
+    np.savez(fname, **arrays)
+
+
+def load_transform_cache(fname):
+    """Load log-polar lookup tables saved by `save_transform_cache`.
+
+    Parameters
+    ----------
+    fname : str
+      File name written by `save_transform_cache`.
+    """
+    with np.load(fname) as archive:
+        for n, key in enumerate(archive['keys']):
+            i_0, j_0, i_n, j_n, p_n, t_n = key
+            key = (i_0, j_0, int(i_n), int(j_n), int(p_n), int(t_n))
+            p_k, t_k, i_k, j_k = archive['table_%d' % n]
+            _transforms.put(key, ((p_k, t_k), (i_k, j_k)))
+        for n, key in enumerate(archive['grid_keys']):
+            i_0, j_0, p_n, t_n, p_s, t_s = key
+            key = (i_0, j_0, int(p_n), int(t_n), p_s, t_s)
+            _grids.put(key, (archive['grid_%d' % n],))
+
 
 def _get_transform(i_0, j_0, i_n, j_n, p_n, t_n, p_s, t_s):
-    transform = _transforms.get((i_0, j_0, i_n, j_n, p_n, t_n))
-    if transform == None:
-        i_k = []
-        j_k = []
-        p_k = []
-        t_k = []
-        for p in range(0, p_n):
-            p_exp = np.exp(p * p_s)
-            for t in range(0, t_n):
-                t_rad = t * t_s
-                i = int(i_0 + p_exp * np.sin(t_rad))
-                j = int(j_0 + p_exp * np.cos(t_rad))
-                if 0 <= i < i_n and 0 <= j < j_n:
-                    i_k.append(i)
-                    j_k.append(j)
-                    p_k.append(p)
-                    t_k.append(t)
-        transform = ((np.array(p_k), np.array(t_k)), (np.array(i_k), np.array(j_k)))
-        _transforms[i_0, j_0, i_n, j_n, p_n, t_n] = transform
+    key = (i_0, j_0, i_n, j_n, p_n, t_n)
+    transform = _transforms.get(key)
+    if transform is None:
+        p_exp = np.exp(np.arange(p_n) * p_s)[:, np.newaxis]
+        t_rad = np.arange(t_n) * t_s
+        # Truncate toward zero like int()
+        i = np.trunc(i_0 + p_exp * np.sin(t_rad)).astype(np.intp)
+        j = np.trunc(j_0 + p_exp * np.cos(t_rad)).astype(np.intp)
+        inside = (0 <= i) & (i < i_n) & (0 <= j) & (j < j_n)
+        p_k, t_k = np.nonzero(inside)
+        transform = ((p_k, t_k), (i[inside], j[inside]))
+        _transforms.put(key, transform)
     return transform
 
 
-def logpolar_fancy(image, i_0, j_0, p_n=None, t_n=None):
-    (i_n, j_n) = image.shape[:2]
-    
+def _logpolar_geometry(i_0, j_0, i_n, j_n, p_n=None, t_n=None):
     i_c = max(i_0, i_n - i_0)
     j_c = max(j_0, j_n - j_0)
     d_c = (i_c ** 2 + j_c ** 2) ** 0.5
     
-    if p_n == None:
+    if p_n is None:
         p_n = int(np.ceil(d_c))
     
-    if t_n == None:
+    if t_n is None:
         t_n = j_n
     
     p_s = np.log(d_c) / p_n
     t_s = 2.0 * np.pi / t_n
+    return p_n, t_n, p_s, t_s
+
+
+def logpolar_fancy(image, i_0, j_0, p_n=None, t_n=None):
+    (i_n, j_n) = image.shape[:2]
+    
+    p_n, t_n, p_s, t_s = _logpolar_geometry(i_0, j_0, i_n, j_n, p_n, t_n)
     
     (pt, ij) = _get_transform(i_0, j_0, i_n, j_n, p_n, t_n, p_s, t_s)
     
@@ -173,20 +881,57 @@ def logpolar_fancy(image, i_0, j_0, p_n=None, t_n=None):
     return transformed
 
 
+_grids = _TransformCache()
+
+
+def _get_grid(i_0, j_0, p_n, t_n, p_s, t_s):
+    key = (i_0, j_0, p_n, t_n, p_s, t_s)
+    grid = _grids.get(key)
+    if grid is None:
+        p_exp = np.exp(np.arange(p_n) * p_s)[:, np.newaxis]
+        t_rad = np.arange(t_n) * t_s
+        grid = (np.stack([i_0 + p_exp * np.sin(t_rad),
+                          j_0 + p_exp * np.cos(t_rad)]),)
+        _grids.put(key, grid)
+    return grid[0]
+
+
+def logpolar_interp(image, i_0, j_0, p_n=None, t_n=None, order=1):
+    """Resample an image, or a stack of images, on a log-polar grid.
+
+    Unlike `logpolar_fancy`, which truncates the coordinates to the
+    nearest pixel, the image is interpolated at the grid coordinates with
+    `scipy.ndimage.map_coordinates`. The grid is computed once per
+    geometry and cached.
+
+    Parameters
+    ----------
+    image : ndarray
+      2D image or 3D stack of images with the image index first.
+    i_0, j_0 : float
+      Row and column of the log-polar origin.
+    p_n, t_n : int, optional
+      Number of radial and angular samples.
+    order : int, optional
+      Spline interpolation order, 1 is bilinear and 3 is cubic.
+
+    Returns
+    -------
+    ndarray
+      Log-polar image of shape (p_n, t_n), or stack of shape
+      (nimages, p_n, t_n).
+    """
+    stack = image if image.ndim == 3 else image[np.newaxis]
+    (i_n, j_n) = stack.shape[1:]
+    p_n, t_n, p_s, t_s = _logpolar_geometry(i_0, j_0, i_n, j_n, p_n, t_n)
+    grid = _get_grid(i_0, j_0, p_n, t_n, p_s, t_s)
+    dtype = np.result_type(stack.dtype, np.float32)
+    transformed = np.empty((stack.shape[0], p_n, t_n), dtype=dtype)
+    for index in range(stack.shape[0]):
+        ndi.map_coordinates(stack[index], grid, output=transformed[index],
+                            order=order, mode='constant', cval=0)
+    return transformed if image.ndim == 3 else transformed[0]
+
+
 if __name__ == '__main__':
-    # Prepare arguments
-    parser = argparse.ArgumentParser(
-        description='Compare two images and get rotation/translation offsets.')
-    parser.add_argument('original_image', help='The original image file')
-    parser.add_argument('flipped_image',
-                        help='Image of the specimen after 180° stage rotation.')
-    parser.add_argument('--passes', '-p', help='How many iterations to run.',
-                        default=15, type=int)
-    args = parser.parse_args()
-    # Perform the correction calculation
-    rot, trans = image_corrections(args.original_image, args.flipped_image,
-                                   passes=args.passes)
-    # Display the result
-    msg = "ΔR: {:.2f}°, ΔX: {:.2f}px, ΔY: {:.2f}px"
-    msg = msg.format(rot, trans[0], trans[1])
-    print(msg)
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# #########################################################################
+# Copyright (c) 2017, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Module for linking the particles labeled in a stack of images into
+trajectories.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import logging
+import numpy as np
+
+from ximage import _lazy
+
+spatial = _lazy.module('scipy.spatial')
+
+logger = logging.getLogger(__name__)
+
+__authors__ = "Francesco De Carlo"
+__copyright__ = "Copyright (c) 2017, Argonne National Laboratory"
+__version__ = "0.0.1"
+__docformat__ = "restructuredtext en"
+__all__ = ['link',
+           'trajectories']
+
+def link(regions, max_displacement, memory=0):
+    """
+    Links the particles of consecutive images into trajectories.
+
+    Each particle is linked to the nearest trajectory end within
+    max_displacement, using a KD-tree of the particle centroids of each
+    image. Conflicts are resolved by linking the closest pairs first.
+
+    Parameters
+    ----------
+    regions : dict
+        Region table returned by ximage.label, at least 'frame' and
+        'centroid'.
+
+    max_displacement : float
+        Largest distance in pixels a particle moves between two images.
+
+    memory : int, optional
+        Number of images a particle can be missing from and still be
+        linked to its trajectory.
+
+    Returns
+    -------
+    ndarray
+        Particle id of each region table entry.
+    """
+
+    frame = np.asarray(regions['frame'])
+    centroid = np.asarray(regions['centroid'], dtype=np.float64)
+    particle = np.empty(len(frame), dtype=np.int64)
+    if len(frame) == 0:
+        return particle
+
+    order = np.argsort(frame, kind='mergesort')
+    bounds = np.flatnonzero(np.diff(frame[order])) + 1
+    bounds = np.concatenate([[0], bounds, [len(order)]])
+
+    # Trajectory ends still open: id, last position and last image.
+    track_id = np.empty(0, dtype=np.int64)
+    track_pos = np.empty((0, 2))
+    track_frame = np.empty(0, dtype=frame.dtype)
+    nr_tracks = 0
+
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        entries = order[lo:hi]
+        current = frame[entries[0]]
+        alive = current - track_frame <= memory + 1
+        track_id, track_pos, track_frame = (track_id[alive], track_pos[alive],
+                                            track_frame[alive])
+
+        pos = centroid[entries]
+        det_track = _match(track_pos, pos, max_displacement)
+
+        # Start a new trajectory for each particle left unmatched.
+        new = det_track < 0
+        nr_new = int(new.sum())
+        ids = np.empty(len(entries), dtype=np.int64)
+        ids[~new] = track_id[det_track[~new]]
+        ids[new] = np.arange(nr_tracks, nr_tracks + nr_new)
+        nr_tracks += nr_new
+        particle[entries] = ids
+
+        track_pos[det_track[~new]] = pos[~new]
+        track_frame[det_track[~new]] = current
+        track_id = np.concatenate([track_id, ids[new]])
+        track_pos = np.concatenate([track_pos, pos[new]])
+        track_frame = np.concatenate([track_frame, np.full(nr_new, current, dtype=frame.dtype)])
+
+    logger.info("Linked %d particles into %d trajectories", len(frame), nr_tracks)
+    return particle
+
+def _match(track_pos, pos, max_displacement):
+    """
+    Greedy nearest neighbour matching of particles to trajectory ends.
+
+    Returns the matched trajectory of each particle, -1 if none.
+    """
+
+    det_track = np.full(len(pos), -1, dtype=np.int64)
+    if len(track_pos) == 0 or len(pos) == 0:
+        return det_track
+    free_tracks = np.arange(len(track_pos))
+    free_dets = np.arange(len(pos))
+    while len(free_tracks) and len(free_dets):
+        tree = spatial.cKDTree(pos[free_dets])
+        dist, nearest = tree.query(track_pos[free_tracks], k=1,
+                                   distance_upper_bound=max_displacement)
+        found = np.isfinite(dist)
+        if not found.any():
+            break
+        # Keep the closest trajectory of each particle.
+        candidates = np.flatnonzero(found)
+        candidates = candidates[np.argsort(dist[candidates], kind='mergesort')]
+        _, first = np.unique(nearest[candidates], return_index=True)
+        winners = candidates[first]
+        det_track[free_dets[nearest[winners]]] = free_tracks[winners]
+        free_dets = np.delete(free_dets, nearest[winners])
+        free_tracks = np.delete(free_tracks, winners)
+    return det_track
+
+def trajectories(regions, particle):
+    """
+    Groups the region table by particle.
+
+    Parameters
+    ----------
+    regions : dict
+        Region table returned by ximage.label.
+
+    particle : ndarray
+        Particle id of each entry, as returned by link.
+
+    Returns
+    -------
+    dict
+        Region table sorted by particle then image, with a 'particle'
+        entry and an 'offsets' array: the entries of particle i are
+        offsets[i]:offsets[i + 1].
+    """
+
+    particle = np.asarray(particle)
+    order = np.lexsort((np.asarray(regions['frame']), particle))
+    tracks = dict((key, np.asarray(value)[order]) for key, value in regions.items())
+    tracks['particle'] = particle[order]
+    counts = np.bincount(particle, minlength=particle.max() + 1 if len(particle) else 0)
+    tracks['offsets'] = np.concatenate([[0], np.cumsum(counts)])
+    return tracks
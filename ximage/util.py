@@ -53,26 +53,45 @@ Utility module for ximage
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import os
+import re
+import time
+import logging
 import fnmatch
-import dxchange
+import threading
+import collections
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-import scipy
-import scipy.ndimage as ndi
-import skimage as ski
+from ximage import _lazy
+
+tifffile = _lazy.module('tifffile')
+ndi = _lazy.module('scipy.ndimage')
+
+logger = logging.getLogger(__name__)
 
 __authors__ = "Francesco De Carlo"
 __copyright__ = "Copyright (c) 2017, Argonne National Laboratory"
 __version__ = "0.0.1"
 __all__ = ['load_raw',
+           'DirectoryIndex',
+           'index_directory',
+           'TiffStack',
            'shutter_off',
            'particle_bed_location',
+           'particle_bed_trajectory',
            'laser_on',
+           'detect_events',
            'scale_to_one',
            'sobel_stack',
-           'label']
+           'label',
+           'label_3d',
+           'scale_to_one_frames',
+           'sobel_frames',
+           'label_frames',
+           'pipeline']
 
-def load_raw(top, index_start):
+def load_raw(top, index_start, index_end=None, step=1, rows=None, cols=None,
+             lazy=False, workers=1, prefix=None):
     """
     Load a stack of tiff images.
 
@@ -84,31 +103,408 @@ def load_raw(top, index_start):
     index_start : int
         Image index start.
 
+    index_end : int, optional
+        Image index end (excluded), default is the last image.
+
+    step : int, optional
+        Load one image every step images.
+
+    rows : tuple of int, optional
+        (start, stop) window of image rows to load, default is all rows.
+
+    cols : tuple of int, optional
+        (start, stop) window of image columns to load, default is all
+        columns.
+
+    lazy : bool, optional
+        If True return a TiffStack that decodes the frames only when they
+        are sliced instead of reading the whole stack in memory.
+
+    workers : int, optional
+        Number of threads decoding the tiff files.
+
+    prefix : str, optional
+        File name prefix of the image series to load, e.g. 'proj_'. Only
+        needed when top holds several series.
+
     Returns
     -------
-    ndarray
+    ndarray or TiffStack
         3D stack of images.
     """
-    template = os.listdir(top)[1]
+    fnames = index_directory(top).select(index_start, index_end, prefix)[::step]
+    stack = TiffStack(fnames, rows=rows, cols=cols, workers=workers)
+    if lazy:
+        return stack
 
-    nfile = len(fnmatch.filter(os.listdir(top), '*.tif'))
+    # Read the tiff raw data.
+    rdata = stack[:]
+    return rdata
 
-    if (nfile == 0):
-        nfile = len(fnmatch.filter(os.listdir(top), '*.tiff'))
+class DirectoryIndex(object):
+    """
+    Sorted table of the numbered tiff files in a directory.
 
-    index_end = index_start + nfile
-    ind_tomo = range(index_start, index_end)
+    The directory is listed once and each file name is split into a series
+    prefix and a frame index, e.g. 'proj_00012.tif' is frame 12 of the
+    'proj_' series, so that dark or flat images stored next to the
+    projections are not mixed in. Use index_directory to get a cached
+    instance instead of scanning the same directory again.
 
-    fname = top + template
+    Parameters
+    ----------
+    top : str
+        Top data directory.
 
-    # Read the tiff raw data.
-    rdata = dxchange.read_tiff_stack(fname, ind=ind_tomo)
-    return rdata
+    Attributes
+    ----------
+    series : dict
+        Maps each prefix to a (indices, fnames) pair sorted by frame index.
+    """
+
+    _pattern = re.compile(r'^(.*?)(\d+)\.tiff?$')
+
+    def __init__(self, top):
+        self.top = top
+        self.mtime = os.stat(top).st_mtime
+        names = os.listdir(top)
+        # Follow load_raw: use the .tiff files only if there is no .tif file.
+        tif = fnmatch.filter(names, '*.tif')
+        if not tif:
+            tif = fnmatch.filter(names, '*.tiff')
+        tables = collections.defaultdict(list)
+        for name in tif:
+            match = self._pattern.match(name)
+            if match is not None:
+                tables[match.group(1)].append((int(match.group(2)), name))
+        self.series = {}
+        for prefix, table in tables.items():
+            table.sort()
+            indices = np.array([index for index, name in table], dtype=np.int64)
+            duplicate = np.flatnonzero(np.diff(indices) == 0)
+            if duplicate.size:
+                raise ValueError("%s holds several %r files with frame index %d: %s, %s"
+                                 % (top, prefix, indices[duplicate[0]],
+                                    table[duplicate[0]][1], table[duplicate[0] + 1][1]))
+            self.series[prefix] = (indices, [os.path.join(top, name) for index, name in table])
+
+    def __len__(self):
+        return sum(len(fnames) for indices, fnames in self.series.values())
+
+    @property
+    def prefixes(self):
+        """
+        Sorted file name prefixes of the image series in the directory.
+        """
+        return sorted(self.series)
+
+    def is_current(self):
+        """
+        Check that the directory did not change since it was indexed.
+        """
+        try:
+            return os.stat(self.top).st_mtime == self.mtime
+        except OSError:
+            return False
+
+    def select(self, index_start=None, index_end=None, prefix=None):
+        """
+        List the files of one series with a frame index in
+        [index_start, index_end).
+
+        Parameters
+        ----------
+        index_start : int, optional
+            First image index, default is the first file.
+
+        index_end : int, optional
+            Image index end (excluded), default is past the last file.
+
+        prefix : str, optional
+            File name prefix of the series, required when the directory
+            holds more than one series.
+
+        Returns
+        -------
+        list of str
+            File names sorted by frame index.
+        """
+        if prefix is None:
+            if len(self.series) > 1:
+                raise ValueError("%s holds several image series %s, select one with prefix"
+                                 % (self.top, self.prefixes))
+            if not self.series:
+                return []
+            prefix = self.prefixes[0]
+        if prefix not in self.series:
+            raise ValueError("%s has no image series with prefix %r, found %s"
+                             % (self.top, prefix, self.prefixes))
+        indices, fnames = self.series[prefix]
+        lo = 0 if index_start is None else np.searchsorted(indices, index_start, 'left')
+        hi = len(fnames) if index_end is None else np.searchsorted(indices, index_end, 'left')
+        return fnames[lo:hi]
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def index_directory(top):
+    """
+    Return the DirectoryIndex of a directory.
+
+    The index is cached and rebuilt only when the modification time of the
+    directory changes, so repeated loads of the same run do not list the
+    directory again.
+
+    Parameters
+    ----------
+    top : str
+        Top data directory.
+
+    Returns
+    -------
+    DirectoryIndex
+        Sorted table of the tiff files in top.
+    """
+    key = os.path.abspath(top)
+    with _indexes_lock:
+        index = _indexes.get(key)
+    if index is None or not index.is_current():
+        index = DirectoryIndex(top)
+        with _indexes_lock:
+            _indexes[key] = index
+    return index
+
+def _window(window, n):
+    """
+    Convert a (start, stop) window or a slice over n pixels to a slice.
+    """
+    if window is None:
+        return slice(0, n)
+    if not isinstance(window, slice):
+        window = slice(*window)
+    start, stop, step = window.indices(n)
+    if step != 1:
+        raise ValueError("row and column windows must be contiguous")
+    return slice(start, max(start, stop))
+
+def _region_segments(page, rows, cols):
+    """
+    List the strips or tiles of a tiff page overlapping a rows x cols
+    window, or None if the page layout does not allow a partial decode.
+    """
+    if (not hasattr(page, 'decode') or len(page.shape) != 2
+            or getattr(page, 'imagedepth', 1) != 1):
+        return None
+    if page.is_tiled:
+        ntiles = -(-page.imagewidth // page.tilewidth)
+        ty = np.arange(rows.start // page.tilelength,
+                       -(-rows.stop // page.tilelength))
+        tx = np.arange(cols.start // page.tilewidth,
+                       -(-cols.stop // page.tilewidth))
+        return (ty[:, np.newaxis] * ntiles + tx).ravel()
+    rps = min(page.rowsperstrip, page.imagelength)
+    return np.arange(rows.start // rps, -(-rows.stop // rps))
+
+def _read_region(fname, rows, cols, out):
+    """
+    Decode the rows x cols window of a tiff file into out.
+
+    Uncompressed files are memory-mapped so only the pages holding the
+    window are read. For compressed files only the strips or tiles
+    overlapping the window are decoded when the layout allows it.
+    """
+    try:
+        out[...] = tifffile.memmap(fname, mode='r')[rows, cols]
+        return out
+    except ValueError:
+        pass
+    with tifffile.TiffFile(fname) as tif:
+        page = tif.pages[0]
+        segments = _region_segments(page, rows, cols)
+        if segments is None:
+            out[...] = page.asarray()[rows, cols]
+            return out
+        fh = tif.filehandle
+        for index in segments:
+            fh.seek(page.dataoffsets[index])
+            data = fh.read(page.databytecounts[index])
+            segment, (_, _, y, x, _), _ = page.decode(
+                data, int(index), jpegtables=page.jpegtables)
+            segment = segment[0, :, :, 0]
+            # Intersect the segment with the window.
+            y0, y1 = max(y, rows.start), min(y + segment.shape[0], rows.stop)
+            x0, x1 = max(x, cols.start), min(x + segment.shape[1], cols.stop)
+            if y0 < y1 and x0 < x1:
+                out[y0 - rows.start:y1 - rows.start, x0 - cols.start:x1 - cols.start] = \
+                    segment[y0 - y:y1 - y, x0 - x:x1 - x]
+    return out
+
+def _read_frames(fnames, out, workers=1, rows=None, cols=None):
+    """
+    Decode a list of tiff files straight into the preallocated 3D array out.
+
+    If rows and cols are given only that window of each file is decoded.
+    """
+    def read(n):
+        if rows is None and cols is None:
+            with tifffile.TiffFile(fnames[n]) as tif:
+                tif.asarray(out=out[n])
+        else:
+            _read_region(fnames[n], rows, cols, out[n])
 
-def shutter_off(image, alpha=0.7):
+    tic = time.time()
+    if workers > 1 and len(fnames) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(read, range(len(fnames))))
+    else:
+        for n in range(len(fnames)):
+            read(n)
+    elapsed = time.time() - tic
+    if elapsed > 0:
+        logger.info("Read %d frames in %.2f s (%.1f frames/s, %d workers)",
+                    len(fnames), elapsed, len(fnames) / elapsed, workers)
+    return out
+
+class TiffStack(object):
+    """
+    Lazy 3D stack of tiff images.
+
+    Frames are decoded only when they are indexed, so the stack can be much
+    larger than the available memory. Uncompressed tiff files are
+    memory-mapped instead of being read. Indexing with an integer returns a
+    2D frame, any other index returns an ndarray holding only the selected
+    frames, so the stack can be passed to functions expecting an ndarray.
+
+    Parameters
+    ----------
+    fnames : list of str
+        File names of the frames, in stack order.
+
+    rows : tuple of int, optional
+        (start, stop) window of image rows, default is all rows.
+
+    cols : tuple of int, optional
+        (start, stop) window of image columns, default is all columns.
+
+    workers : int, optional
+        Number of threads decoding the frames of a multi-frame selection.
+    """
+
+    def __init__(self, fnames, rows=None, cols=None, workers=1):
+        self.fnames = list(fnames)
+        self.workers = workers
+        if not self.fnames:
+            raise ValueError("TiffStack needs at least one file")
+        with tifffile.TiffFile(self.fnames[0]) as tif:
+            page = tif.pages[0]
+            frame_shape = tuple(page.shape)
+            self.dtype = np.dtype(page.dtype)
+        try:
+            tifffile.memmap(self.fnames[0], mode='r')
+            self._mappable = True
+        except ValueError:
+            self._mappable = False
+        self._cropped = rows is not None or cols is not None
+        self.rows = _window(rows, frame_shape[0])
+        self.cols = _window(cols, frame_shape[1])
+        self.shape = (len(self.fnames),
+                      self.rows.stop - self.rows.start,
+                      self.cols.stop - self.cols.start) + frame_shape[2:]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._read_frame(index)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    def __getitem__(self, key):
+        key = self._expand_key(key)
+        frame_key, rest = key[0], key[1:]
+        if isinstance(frame_key, (int, np.integer)):
+            index = int(frame_key)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("frame index %d is out of range" % frame_key)
+            return self._read_frame(index)[rest]
+        frames = np.arange(len(self))[frame_key]
+        if all(isinstance(k, slice) and k == slice(None) for k in rest):
+            out = np.empty((len(frames),) + self.shape[1:], dtype=self.dtype)
+            if self._cropped:
+                return _read_frames([self.fnames[i] for i in frames], out,
+                                    self.workers, self.rows, self.cols)
+            return _read_frames([self.fnames[i] for i in frames], out,
+                                self.workers)
+        out = None
+        for n, index in enumerate(frames):
+            frame = self._read_frame(index)[rest]
+            if out is None:
+                out = np.empty((len(frames),) + frame.shape, dtype=self.dtype)
+            out[n] = frame
+        if out is None:
+            out = np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+        return out
+
+    def _expand_key(self, key):
+        # Replace an Ellipsis by full slices so that key[0] always indexes
+        # the frames, as it would for an ndarray of the same shape.
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is None for k in key):
+            raise IndexError("TiffStack does not support np.newaxis indices")
+        ellipses = sum(1 for k in key if k is Ellipsis)
+        if ellipses > 1:
+            raise IndexError("an index can only have a single ellipsis ('...')")
+        ndim = sum(np.ndim(k) if np.asarray(k).dtype == bool else 1
+                   for k in key if k is not Ellipsis)
+        if ndim > self.ndim:
+            raise IndexError("too many indices for TiffStack: stack is %d-dimensional, "
+                             "but %d were indexed" % (self.ndim, ndim))
+        if ellipses:
+            at = [k is Ellipsis for k in key].index(True)
+            key = key[:at] + (slice(None),) * (self.ndim - ndim) + key[at + 1:]
+        if not isinstance(key[0], (int, np.integer, slice)) and \
+                any(not isinstance(k, (int, np.integer, slice)) for k in key[1:]):
+            raise IndexError("TiffStack does not support array indices on the "
+                             "frame axis combined with array indices on the "
+                             "image axes")
+        return key
+
+    def _read_frame(self, index):
+        fname = self.fnames[index]
+        if self._cropped:
+            out = np.empty(self.shape[1:], dtype=self.dtype)
+            return _read_region(fname, self.rows, self.cols, out)
+        if self._mappable:
+            try:
+                return tifffile.memmap(fname, mode='r')
+            except ValueError:
+                pass
+        return tifffile.imread(fname)
+
+def shutter_off(image, alpha=0.7, chunk=64, bisect=False):
     """
     Finds the first image with the shutter closed.
 
+    The image sums are computed chunk by chunk and the search stops at the
+    first chunk holding a closed shutter image, so with a TiffStack only the
+    frames up to the transition are decoded.
+
     Parameters
     ----------
     image : ndarray
@@ -117,6 +513,13 @@ def shutter_off(image, alpha=0.7):
     alpha : float
         Threshold level.
 
+    chunk : int, optional
+        Number of images summed at once.
+
+    bisect : bool, optional
+        If True assume the image sum does not increase once the shutter
+        starts to close and bisect the stack, reading log2(nimages) images.
+
     Returns
     -------
     int
@@ -124,11 +527,22 @@ def shutter_off(image, alpha=0.7):
     """
 
     flat_sum = np.sum(image[0, :, :])
+    threshold = alpha * flat_sum
     nimages = image.shape[0]
-    for index in range(nimages):
-        image_sum = np.sum(image[index, :, :])
-        if image_sum < alpha * flat_sum :
-            return index
+    if bisect:
+        lo, hi = 0, nimages
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if np.sum(image[mid, :, :]) < threshold:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo if lo < nimages else None
+    for start in range(0, nimages, chunk):
+        image_sum = np.sum(image[start:start + chunk], axis=(1, 2))
+        closed = np.flatnonzero(image_sum < threshold)
+        if closed.size:
+            return start + int(closed[0])
     return None
 
 def particle_bed_location(image):
@@ -147,13 +561,79 @@ def particle_bed_location(image):
     """
 
     edge = np.sum(image, axis=1)
-    x = np.arange(0, edge.shape[0], 1)
-    y = ndi.gaussian_filter(edge/float(np.amax(edge)), 5)
-    return np.abs(y - 0.5).argmin()
+    return _bed_rows(edge[np.newaxis])[0]
+
+def _bed_profiles(edges, sigma=5):
+    """
+    Normalizes and smooths a (nimages, nrows) stack of row sums, minus 0.5.
+    """
+    y = edges / np.amax(edges, axis=1, keepdims=True)
+    return ndi.gaussian_filter1d(y, sigma, axis=1) - 0.5
+
+def _bed_rows(edges, sigma=5, subpixel=False):
+    """
+    Finds the particle bed row from a (nimages, nrows) stack of row sums.
+    """
+    y = _bed_profiles(edges, sigma)
+    rows = np.abs(y).argmin(axis=1)
+    if subpixel:
+        return _refine_bed_rows(y, rows)
+    return rows
 
-def laser_on(rdata, particle_bed_ref, alpha=1.0):
+def _refine_bed_rows(y, rows):
     """
-    Function description.
+    Interpolates the 0.5 crossing between the bed row and the neighbour
+    row on the other side of the crossing.
+    """
+    index = np.arange(len(rows))
+    y_row = y[index, rows]
+    after = np.minimum(rows + 1, y.shape[1] - 1)
+    before = np.maximum(rows - 1, 0)
+    neighbour = np.where(np.sign(y[index, after]) != np.sign(y_row), after, before)
+    y_neighbour = y[index, neighbour]
+    crossing = (np.sign(y_neighbour) != np.sign(y_row)) & (neighbour != rows)
+    step = np.zeros(len(rows))
+    step[crossing] = y_row[crossing] / (y_row[crossing] - y_neighbour[crossing])
+    return rows + step * (neighbour - rows)
+
+def particle_bed_trajectory(rdata, chunk=64, subpixel=False):
+    """
+    Finds the image row marking the location of the particle bed in each
+    image of a stack.
+
+    The row sums of chunk images are taken at once and smoothed together,
+    giving the same rows as particle_bed_location called on each image.
+
+    Parameters
+    ----------
+    rdata : ndarray
+        3D stack of images.
+
+    chunk : int, optional
+        Number of images processed at once.
+
+    subpixel : bool, optional
+        If True refine the rows by interpolating the smoothed row profile.
+
+    Returns
+    -------
+    ndarray
+        Particle bed row of each image, int or float if subpixel is True.
+    """
+    nimages = rdata.shape[0]
+    rows = np.empty(nimages, dtype=np.float64 if subpixel else np.intp)
+
+    for start in range(0, nimages, chunk):
+        edges = np.sum(rdata[start:start + chunk], axis=2)
+        rows[start:start + chunk] = _bed_rows(edges, subpixel=subpixel)
+    return rows
+
+def laser_on(rdata, particle_bed_ref, alpha=1.0, chunk=64):
+    """
+    Finds the first image with the laser on.
+
+    The row sums of chunk images are taken at once and smoothed together,
+    and the search stops at the first chunk holding a laser on image.
 
     Parameters
     ----------
@@ -166,73 +646,197 @@ def laser_on(rdata, particle_bed_ref, alpha=1.0):
     alpha : float
         Threshold level.
 
+    chunk : int, optional
+        Number of images processed at once.
+
     Returns
     -------
     int
         Index of the first image with the laser on.
     """
     nimages = rdata.shape[0]
-    status = np.empty(nimages)
 
-    for index in range(nimages):
-        ndata = rdata[index]
-        edge = np.sum(ndata, axis=1)
-        y = ndi.gaussian_filter(edge/float(np.amax(edge)), 5)
-        particle_bed = np.abs(y - 0.5).argmin()
-
-        if particle_bed > particle_bed_ref * alpha :
-            return index
+    for start in range(0, nimages, chunk):
+        edges = np.sum(rdata[start:start + chunk], axis=2)
+        particle_bed = _bed_rows(edges)
+        on = np.flatnonzero(particle_bed > particle_bed_ref * alpha)
+        if on.size:
+            return start + int(on[0])
     return None
 
-def scale_to_one(ndata):
+Events = collections.namedtuple('Events',
+                                ['shutter_off', 'laser_on', 'particle_bed'])
+
+def detect_events(rdata, shutter_alpha=0.7, laser_alpha=1.0, chunk=64,
+                  subpixel=False):
+    """
+    Finds the shutter closed image, the laser on image and the particle bed
+    row of each image reading the stack only once.
+
+    Each chunk of images is reduced to its row sums, which give both the
+    image sums used by shutter_off and the row profiles used by laser_on
+    and particle_bed_trajectory. The particle bed reference is the bed row
+    of the first image.
+
+    Parameters
+    ----------
+    rdata : ndarray
+        3D stack of images.
+
+    shutter_alpha : float, optional
+        Threshold level of shutter_off.
+
+    laser_alpha : float, optional
+        Threshold level of laser_on.
+
+    chunk : int, optional
+        Number of images processed at once.
+
+    subpixel : bool, optional
+        If True refine the particle bed rows by interpolation.
+
+    Returns
+    -------
+    Events
+        Named tuple holding the index of the first image with the shutter
+        closed, the index of the first image with the laser on (None if not
+        found) and the particle bed row of each image.
+    """
+    nimages = rdata.shape[0]
+    particle_bed = np.empty(nimages, dtype=np.float64 if subpixel else np.intp)
+    shutter_index = None
+    laser_index = None
+
+    for start in range(0, nimages, chunk):
+        edges = np.sum(rdata[start:start + chunk], axis=2)
+        y = _bed_profiles(edges)
+        rows = np.abs(y).argmin(axis=1)
+        if start == 0:
+            flat_sum = np.sum(edges[0])
+            particle_bed_ref = rows[0]
+        if shutter_index is None:
+            closed = np.flatnonzero(np.sum(edges, axis=1) < shutter_alpha * flat_sum)
+            if closed.size:
+                shutter_index = start + int(closed[0])
+        if laser_index is None:
+            on = np.flatnonzero(rows > particle_bed_ref * laser_alpha)
+            if on.size:
+                laser_index = start + int(on[0])
+        if subpixel:
+            rows = _refine_bed_rows(y, rows)
+        particle_bed[start:start + chunk] = rows
+    return Events(shutter_index, laser_index, particle_bed)
+
+def scale_to_one(ndata, out=None, dtype=np.float32, mode='frame', chunk=64):
     """
     Scale a stack of images between [0,1].
 
+    The minimum and maximum are reduced for chunk images at once and the
+    scaled images are written to a floating point output, so integer
+    stacks from the camera are not truncated. Flat images are set to 0.
+
     Parameters
     ----------
     ndata : ndarray
         3D stack of images.
 
+    out : ndarray, optional
+        Output stack, it can be ndata itself if it is a floating point
+        stack. By default a new stack is allocated.
+
+    dtype : data-type, optional
+        Data type of the allocated output stack.
+
+    mode : str, optional
+        'frame' scales each image by its own minimum and maximum, 'global'
+        uses the minimum and maximum of the whole stack.
+
+    chunk : int, optional
+        Number of images processed at once.
+
     Returns
     -------
     ndarray
         3D stack of images.
     """
 
-    ndata_max = np.amax(ndata)
-    ndata_min = np.amin(ndata)
+    if mode not in ('frame', 'global'):
+        raise ValueError("mode must be 'frame' or 'global', not %r" % (mode,))
+    if out is None:
+        out = np.empty(ndata.shape, dtype=dtype)
     nimages = ndata.shape[0]
-    for index in range(nimages):
-        # normalize between [0,1]
-        ndata_max = np.amax(ndata[index, :, :])
-        ndata_min = np.amin(ndata[index, :, :])
-        ndata[index, :, :] = (ndata[index, :, :] - ndata_min) / (ndata_max - ndata_min)
-    return ndata
 
-def sobel_stack(ndata):
+    if mode == 'global':
+        ndata_min = np.inf
+        ndata_max = -np.inf
+        for start in range(0, nimages, chunk):
+            block = ndata[start:start + chunk]
+            ndata_min = min(ndata_min, np.amin(block))
+            ndata_max = max(ndata_max, np.amax(block))
+
+    for start in range(0, nimages, chunk):
+        block = ndata[start:start + chunk]
+        if mode == 'frame':
+            ndata_min = np.amin(block, axis=(1, 2), keepdims=True)
+            ndata_max = np.amax(block, axis=(1, 2), keepdims=True)
+        _scale_block(block, ndata_min, ndata_max, out[start:start + chunk])
+    return out
+
+def sobel_stack(ndata, out=None, dtype=np.float32, workers=1, chunk=16):
     """
     Applies sobel filter to a stack of images.
 
+    Blocks of chunk images are filtered at once with 1D correlations along
+    the image rows and columns only, and the blocks are spread over a pool
+    of threads.
+
     Parameters
     ----------
     ndata : ndarray
         3D stack of images.
 
+    out : ndarray, optional
+        Output stack, it can be ndata itself if it is a floating point
+        stack. By default a new stack is allocated.
+
+    dtype : data-type, optional
+        Data type of the allocated output stack.
+
+    workers : int, optional
+        Number of threads filtering the blocks.
+
+    chunk : int, optional
+        Number of images filtered at once.
+
     Returns
     -------
     ndarray
         3D stack of images.
     """
 
+    if out is None:
+        out = np.empty(ndata.shape, dtype=dtype)
     nimages = ndata.shape[0]
-    for index in range(nimages):
-        ndata[index, :, :] = ski.filters.sobel(ndata[index, :, :])
-    return ndata
 
-def label(ndata, blur_radius=1.0, alpha=1):
+    def filter_block(start):
+        _sobel_block(ndata[start:start + chunk], out[start:start + chunk])
+
+    starts = range(0, nimages, chunk)
+    if workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(filter_block, starts))
+    else:
+        for start in starts:
+            filter_block(start)
+    return out
+
+def label(ndata, blur_radius=1.0, alpha=1, out=None, workers=1):
     """
     Counts the number of particles in a stack of images.
 
+    Each image is blurred, thresholded and labeled on a pool of threads,
+    and the particles of all the images are measured in a region table.
+
     Parameters
     ----------
     ndata : ndarray
@@ -244,16 +848,301 @@ def label(ndata, blur_radius=1.0, alpha=1):
     alpha : float
         Threshold level.
 
+    out : ndarray, optional
+        int32 output stack of labels. By default a new stack is allocated.
+
+    workers : int, optional
+        Number of threads labeling the images.
+
     Returns
     -------
-    ndata, nr_objects
-        3D stack of images, number of particles per image.
+    labels, nr_objects, regions
+        3D stack of labels, number of particles per image and region
+        table. The region table is a dict of arrays with one entry per
+        particle: 'frame', 'label', 'area', 'centroid' (row, col), 'bbox'
+        (min_row, min_col, max_row, max_col, max excluded) and
+        'mean_intensity'.
+    """
+
+    nimages = ndata.shape[0]
+    if out is None:
+        out = np.empty(ndata.shape, dtype=np.int32)
+    nr_objects = np.zeros(nimages, dtype=np.int64)
+    tables = [None] * nimages
+
+    def label_image(index):
+        image = np.asarray(ndata[index, :, :])
+        blurred = ndi.gaussian_filter(image, blur_radius)
+        nr_objects[index] = ndi.label(blurred > alpha, output=out[index])
+        tables[index] = _region_table(out[index], image, nr_objects[index], index)
+
+    if workers > 1 and nimages > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(label_image, range(nimages)))
+    else:
+        for index in range(nimages):
+            label_image(index)
+    logger.info("Labeled %d particles in %d images", nr_objects.sum(), nimages)
+
+    regions = dict((key, np.concatenate([table[key] for table in tables]))
+                   for key in tables[0]) if nimages else {}
+    return out, nr_objects, regions
+
+def label_3d(ndata, blur_radius=1.0, alpha=1, chunk=64, structure=None,
+             out=None):
     """
+    Labels the particles of a stack of images across time, so a particle
+    seen in several consecutive images gets a single label.
 
+    The stack is labeled in 3D one chunk of images at a time and the labels
+    touching across the chunk boundaries are merged with a union-find, so
+    only one chunk of images is held in memory besides the output.
+
+    Parameters
+    ----------
+    ndata : ndarray
+        3D stack of images.
+
+    blur_radius : float
+        Gaussian blur radius, applied to each image.
+
+    alpha : float
+        Threshold level.
+
+    chunk : int, optional
+        Number of images labeled at once.
+
+    structure : ndarray, optional
+        3D connectivity structure, default is face connectivity.
+
+    out : ndarray, optional
+        int32 output stack of labels, e.g. a numpy.memmap for stacks not
+        fitting in memory. By default a new stack is allocated.
+
+    Returns
+    -------
+    labels, nr_objects
+        3D stack of labels, number of particles in the stack.
+    """
 
     nimages = ndata.shape[0]
-    for index in range(nimages):
-        ndata[index, :, :] = ndi.gaussian_filter(ndata[index, :, :], blur_radius)
-        ndata[index, :, :], nr_objects = scipy.ndimage.label(ndata[index, :, :] > alpha) 
-        print ("Image %d contains %d particles" % (index, nr_objects))
-    return ndata, nr_objects
+    if out is None:
+        out = np.empty(ndata.shape, dtype=np.int32)
+    if structure is None:
+        structure = ndi.generate_binary_structure(3, 1)
+    parent = np.zeros(1, dtype=np.int64)
+    previous = None
+
+    for start in range(0, nimages, chunk):
+        block = np.asarray(ndata[start:start + chunk])
+        blurred = ndi.gaussian_filter(block, (0, blur_radius, blur_radius))
+        labels = out[start:start + chunk]
+        nr_block = ndi.label(blurred > alpha, structure, output=labels)
+        offset = len(parent) - 1
+        labels[labels > 0] += offset
+        parent = np.concatenate([parent, np.arange(offset + 1, offset + nr_block + 1)])
+        if previous is not None:
+            _merge_boundary(parent, previous, labels[0], structure)
+        previous = labels[-1].copy()
+
+    # Point every label to its root and number the roots consecutively.
+    while True:
+        grand_parent = parent[parent]
+        if np.array_equal(grand_parent, parent):
+            break
+        parent = grand_parent
+    roots, lut = np.unique(parent, return_inverse=True)
+    lut = lut.astype(np.int32)
+    nr_objects = len(roots) - 1
+    for start in range(0, nimages, chunk):
+        out[start:start + chunk] = lut[out[start:start + chunk]]
+    logger.info("Labeled %d particles in %d images", nr_objects, nimages)
+    return out, nr_objects
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _merge_boundary(parent, last, first, structure):
+    """
+    Merges the labels of two consecutive images connected by structure.
+    """
+    slab, nr_slab = ndi.label(np.stack([last > 0, first > 0]), structure)
+    if nr_slab == 0:
+        return
+    labels = np.stack([last, first])
+    mask = labels > 0
+    pairs = np.unique(np.stack([slab[mask], labels[mask]], axis=1), axis=0)
+    # Pairs are sorted by slab component: union each label with the first
+    # label of its component.
+    first_of_component = np.ones(len(pairs), dtype=bool)
+    first_of_component[1:] = pairs[1:, 0] != pairs[:-1, 0]
+    heads = np.maximum.accumulate(np.where(first_of_component, np.arange(len(pairs)), 0))
+    for head, current in zip(pairs[heads, 1], pairs[:, 1]):
+        if head != current:
+            head_root, current_root = _find(parent, head), _find(parent, current)
+            if head_root != current_root:
+                parent[max(head_root, current_root)] = min(head_root, current_root)
+
+def _region_table(labels, image, nr_objects, index):
+    """
+    Measures the labeled regions of an image with vectorized reductions.
+    """
+    nr_objects = int(nr_objects)
+    ids = np.arange(1, nr_objects + 1)
+    flat = labels.ravel()
+    area = np.bincount(flat, minlength=nr_objects + 1)[1:]
+    rows, cols = np.indices(labels.shape)
+    centroid = np.empty((nr_objects, 2))
+    bbox = np.empty((nr_objects, 4), dtype=np.intp)
+    if nr_objects:
+        centroid[:, 0] = np.bincount(flat, rows.ravel(), nr_objects + 1)[1:] / area
+        centroid[:, 1] = np.bincount(flat, cols.ravel(), nr_objects + 1)[1:] / area
+        bbox[:, 0] = ndi.minimum(rows, labels, ids)
+        bbox[:, 1] = ndi.minimum(cols, labels, ids)
+        bbox[:, 2] = ndi.maximum(rows, labels, ids) + 1
+        bbox[:, 3] = ndi.maximum(cols, labels, ids) + 1
+        mean_intensity = np.bincount(flat, image.ravel(), nr_objects + 1)[1:] / area
+    else:
+        mean_intensity = np.empty(0)
+    return {'frame': np.full(nr_objects, index, dtype=np.intp),
+            'label': ids.astype(np.int32),
+            'area': area,
+            'centroid': centroid,
+            'bbox': bbox,
+            'mean_intensity': mean_intensity}
+
+def _scale_block(block, block_min, block_max, out):
+    # normalize between [0,1] without temporaries
+    block_min = np.asarray(block_min, dtype=out.dtype)
+    block_range = np.asarray(block_max, dtype=out.dtype) - block_min
+    scale = np.zeros_like(block_range)
+    np.divide(1, block_range, out=scale, where=block_range != 0)
+    np.subtract(block, block_min, out=out, dtype=out.dtype, casting='unsafe')
+    np.multiply(out, scale, out=out)
+    return out
+
+def _scale_frame(frame, dtype=np.float32):
+    out = np.empty(frame.shape, dtype=dtype)
+    return _scale_block(frame, np.amin(frame), np.amax(frame), out)
+
+def _sobel_block(block, out):
+    # same as skimage.filters.sobel on each image of the block
+    block = np.asarray(block, dtype=out.dtype)
+    smooth = np.empty_like(out)
+    edge = np.empty_like(out)
+    ndi.correlate1d(block, [1, 2, 1], axis=2, output=smooth)
+    ndi.correlate1d(smooth, [1, 0, -1], axis=1, output=edge)
+    ndi.correlate1d(block, [1, 2, 1], axis=1, output=smooth)
+    ndi.correlate1d(smooth, [1, 0, -1], axis=2, output=out)
+    np.hypot(edge, out, out=out)
+    out *= 1 / (4 * np.sqrt(2))
+    return out
+
+def _sobel_frame(frame, dtype=np.float32):
+    out = np.empty((1,) + frame.shape, dtype=dtype)
+    return _sobel_block(frame[np.newaxis], out)[0]
+
+def _label_frame(frame, blur_radius, alpha):
+    blurred = ndi.gaussian_filter(frame, blur_radius)
+    return ndi.label(blurred > alpha)
+
+def scale_to_one_frames(frames, dtype=np.float32):
+    """
+    Scale each image of a frame iterator between [0,1].
+
+    Parameters
+    ----------
+    frames : iterable
+        2D images, e.g. a 3D stack, a TiffStack or another stage.
+
+    dtype : data-type, optional
+        Data type of the scaled images.
+
+    Yields
+    ------
+    ndarray
+        2D scaled image.
+    """
+
+    for frame in frames:
+        yield _scale_frame(frame, dtype)
+
+def sobel_frames(frames, dtype=np.float32):
+    """
+    Applies sobel filter to each image of a frame iterator.
+
+    Parameters
+    ----------
+    frames : iterable
+        2D images, e.g. a 3D stack, a TiffStack or another stage.
+
+    dtype : data-type, optional
+        Data type of the filtered images.
+
+    Yields
+    ------
+    ndarray
+        2D filtered image.
+    """
+
+    for frame in frames:
+        yield _sobel_frame(frame, dtype)
+
+def label_frames(frames, blur_radius=1.0, alpha=1):
+    """
+    Labels the particles in each image of a frame iterator.
+
+    Parameters
+    ----------
+    frames : iterable
+        2D images, e.g. a 3D stack, a TiffStack or another stage.
+
+    blur_radius : float
+        Gaussian blur radius.
+
+    alpha : float
+        Threshold level.
+
+    Yields
+    ------
+    labels, nr_objects
+        2D labels, number of particles in the image.
+    """
+
+    for frame in frames:
+        yield _label_frame(frame, blur_radius, alpha)
+
+def pipeline(frames, *stages):
+    """
+    Chains frame iterator stages.
+
+    Each frame goes through all the stages before the next one is read, so
+    only a few frames are held in memory whatever the stack size, e.g.::
+
+        stages = pipeline(ximage.load_raw(top, 1, lazy=True),
+                          ximage.scale_to_one_frames,
+                          ximage.sobel_frames,
+                          functools.partial(ximage.label_frames, alpha=0.04))
+        counts = [nr_objects for labels, nr_objects in stages]
+
+    Parameters
+    ----------
+    frames : iterable
+        2D images, e.g. a 3D stack or a TiffStack.
+
+    stages : callables
+        Functions taking a frame iterator and returning a frame iterator.
+
+    Returns
+    -------
+    iterator
+        Output of the last stage.
+    """
+
+    frames = iter(frames)
+    for stage in stages:
+        frames = stage(frames)
+    return frames
@@ -52,6 +52,9 @@ This module contains the ximage widgets
 
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import weakref
+import threading
+from collections import OrderedDict
 import numpy as np
 import matplotlib.pylab as pl
 import matplotlib.widgets as wdg
@@ -66,29 +69,126 @@ class slider():
     """
     Plots a stack of images.
 
+    The frames are downsampled to the resolution of the axes on screen and
+    kept in a least recently used cache. The neighbouring frames are
+    prefetched on a background thread and the image is redrawn with
+    blitting, so disk-backed stacks such as ximage.TiffStack can be
+    scrubbed without reading full frames.
+
     Parameters
     ----------
     data : ndarray
         3D stack of images.
+
+    cache_size : int, optional
+        Number of downsampled frames kept in memory.
+
+    prefetch : int, optional
+        Number of frames prefetched on each side of the current frame.
     """
 
-    def __init__(self, data):
+    def __init__(self, data, cache_size=64, prefetch=4):
         self.data = data
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._background = None
 
         ax = pl.subplot(111)
         pl.subplots_adjust(left=0.25, bottom=0.25)
+        self.ax = ax
+        self.canvas = ax.figure.canvas
+
+        # Stride giving frames no larger than the axes on screen
+        nrows, ncols = self.data.shape[1:3]
+        bbox = ax.get_window_extent()
+        self.step = max(1, int(np.ceil(max(nrows / max(bbox.height, 1),
+                                           ncols / max(bbox.width, 1)))))
 
         self.frame = 0
-        self.l = pl.imshow(self.data[self.frame,:,:], cmap='gray') 
+        self.l = pl.imshow(self._get_frame(self.frame), cmap='gray',
+                           extent=(-0.5, ncols - 0.5, nrows - 0.5, -0.5))
 
         axcolor = 'lightgoldenrodyellow'
-        axframe = pl.axes([0.25, 0.1, 0.65, 0.03], axisbg=axcolor)
+        axframe = pl.axes([0.25, 0.1, 0.65, 0.03], facecolor=axcolor)
+        self.axframe = axframe
         self.sframe = wdg.Slider(axframe, 'Frame', 0, self.data.shape[0]-1, valfmt='%0.0f')
+        self.sframe.drawon = False
         self.sframe.on_changed(self.update)
 
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.canvas.mpl_connect('close_event', self._on_close)
+        # The thread only holds a weak reference, so that it does not keep
+        # the stack alive once the slider or its figure is gone.
+        thread = threading.Thread(target=_prefetch_loop,
+                                  args=(weakref.ref(self), self._wake))
+        thread.daemon = True
+        thread.start()
+        self._wake.set()
+
         pl.show()
 
     def update(self, val):
         self.frame = int(np.around(self.sframe.val))
-        self.l.set_data(self.data[self.frame,:,:])
+        self.l.set_data(self._get_frame(self.frame))
+        self._wake.set()
+        if self._background is None or not self.canvas.supports_blit:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._background)
+        self.ax.draw_artist(self.l)
+        self.ax.figure.draw_artist(self.axframe)
+        self.canvas.blit(self.ax.bbox)
+        self.canvas.blit(self.axframe.bbox)
+
+    def _get_frame(self, index):
+        with self._lock:
+            frame = self._cache.get(index)
+            if frame is not None:
+                self._cache.move_to_end(index)
+                return frame
+        frame = np.ascontiguousarray(self.data[index, ::self.step, ::self.step])
+        with self._lock:
+            self._cache[index] = frame
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def _is_alive(self):
+        # Non-GUI backends (Agg, inline) never send close_event, so also
+        # check that pyplot still manages the figure.
+        return not self._closed and pl.fignum_exists(self.ax.figure.number)
+
+    def _prefetch(self):
+        nimages = self.data.shape[0]
+        center = self.frame
+        for offset in range(1, self.prefetch + 1):
+            if self._wake.is_set() or self._closed:
+                break
+            for index in (center + offset, center - offset):
+                if 0 <= index < nimages:
+                    self._get_frame(index)
+
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.ax.figure.bbox)
+
+    def _on_close(self, event):
+        self._closed = True
+        self._wake.set()
+
 
+def _prefetch_loop(ref, wake, timeout=1.0):
+    # Prefetch loop of a slider, exits once the slider is garbage
+    # collected or its figure is closed.
+    while True:
+        woken = wake.wait(timeout)
+        widget = ref()
+        if widget is None or not widget._is_alive():
+            return
+        if woken:
+            wake.clear()
+            widget._prefetch()
+        del widget